@@ -1,34 +1,99 @@
+import hashlib
+import html
+import re
+import time
+from pathlib import Path
+
 import streamlit as st
 import pandas as pd
 import numpy as np
-import yfinance as yf
-import plotly.express as px
 
 # --- CONFIGURATION ---
 st.set_page_config(page_title="Risk Parity & Tax Location Optimizer", layout="wide")
 
+CACHE_DIR = Path(".cache")
+CACHE_TTL = 3600  # Seconds before cached price history is considered stale
+
+# Tax Inefficiency Score per ticker (Arbitrary Heuristic for this demo)
+# Higher score = Worse for taxable account (Needs shelter)
+TAX_INEFFICIENCY = {
+    'TLT': 10, 'IEF': 10, 'BND': 10,  # Bonds (Interest taxed as income)
+    'GLD': 8, 'DBC': 8,               # Commodities (Collectibles tax / K-1s)
+    'VNQ': 9,                         # REITs (Unqualified divs)
+    'SPY': 2, 'VTI': 2, 'QQQ': 2,     # Stocks (Capital gains/Qualified divs)
+    'EEM': 3, 'VEA': 3                # International (Foreign tax credit potential)
+}
+
+# Tax treatment label per account priority (1 = best shelter)
+TAX_LABELS = ('Tax-Free', 'Deferred', 'Taxable')
+
+# Account name keywords: group 1 = Roth/HSA (Tax-Free), group 2 = IRA/401k (Deferred).
+# Both alternatives are lookaheads anchored at the start so Roth/HSA wins wherever it appears.
+ACCOUNT_PRIORITY_RE = re.compile(r'(?=.*(Roth|HSA))|(?=.*(IRA|401k))', re.DOTALL)
+
 # --- HELPER FUNCTIONS ---
 
-def get_market_data(tickers, period="1y"):
-    """Fetch historical data to calculate volatility."""
-    data = yf.download(tickers, period=period, group_by='ticker', auto_adjust=True)
+def account_priority(acc_name):
+    """Tax advantage rank of an account: 1 = Roth/HSA, 2 = IRA/401k, 3 = Taxable."""
+    m = ACCOUNT_PRIORITY_RE.match(acc_name)
+    return 1 if m and m.group(1) else 2 if m and m.group(2) else 3
+
+def _price_cache_path(tickers, period):
+    """Stable on-disk location for a (tickers, period) price history."""
+    key = hashlib.sha1(f"{','.join(tickers)}|{period}".encode()).hexdigest()
+    return CACHE_DIR / f"{key}.parquet"
+
+def load_cached_prices(tickers, period):
+    """Return cached close prices if a fresh copy exists on disk, else None."""
+    path = _price_cache_path(tickers, period)
+    try:
+        if time.time() - path.stat().st_mtime > CACHE_TTL:
+            return None
+        return pd.read_parquet(path)
+    except (OSError, ValueError):
+        return None
+
+def store_cached_prices(tickers, period, close_data):
+    """Persist close prices to disk; caching is best-effort only."""
+    try:
+        CACHE_DIR.mkdir(exist_ok=True)
+        close_data.to_parquet(_price_cache_path(tickers, period))
+    except (OSError, ValueError):
+        pass
+
+def download_close_prices(tickers, period):
+    """Download close prices from Yahoo Finance."""
+    import yfinance as yf  # Deferred: heavy import, only needed on a cache miss
+    
+    data = yf.download(list(tickers), period=period, group_by='ticker', auto_adjust=True)
     
-    # Handle single vs multiple tickers
-    if len(tickers) == 1:
+    # Handle single vs multiple tickers (columns are (ticker, field) pairs when grouped)
+    if isinstance(data.columns, pd.MultiIndex):
+        # Slice every ticker's Close column in one go, dropping tickers with no data
+        close_data = data.xs('Close', axis=1, level=1).reindex(columns=list(tickers)).dropna(how='all', axis=1)
+    else:
         if 'Close' not in data.columns:
             raise ValueError(f"Close price data not available for {tickers[0]}")
-        close_data = data['Close']
-    else:
-        # For multiple tickers, extract Close prices
-        close_data = pd.DataFrame({ticker: data[ticker]['Close'] for ticker in tickers if ticker in data.columns.get_level_values(0)})
+        close_data = data[['Close']].rename(columns={'Close': tickers[0]})
     
     if close_data.empty:
         raise ValueError("No valid price data could be retrieved")
+    return close_data
+
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def get_market_data(tickers, period="1y"):
+    """Fetch historical data to calculate volatility."""
+    close_data = load_cached_prices(tickers, period)
+    if close_data is None:
+        close_data = download_close_prices(tickers, period)
+        store_cached_prices(tickers, period, close_data)
     
-    # Calculate daily returns
-    returns = close_data.pct_change().dropna()
+    # Calculate daily log returns, skipping days where any ticker has no price
+    log_prices = np.log(close_data.to_numpy(dtype=np.float64))
+    returns = log_prices[1:] - log_prices[:-1]
+    returns = returns[~np.isnan(returns).any(axis=1)]
     # Calculate annualized volatility
-    volatility = returns.std() * np.sqrt(252)
+    volatility = pd.Series(returns.std(axis=0, ddof=1) * np.sqrt(252), index=close_data.columns)
     return volatility, close_data.iloc[-1]
 
 def calculate_risk_parity_weights(volatilities):
@@ -38,11 +103,11 @@ def calculate_risk_parity_weights(volatilities):
     """
     # Handle zero or near-zero volatility
     min_vol = 0.001  # Minimum volatility threshold
-    volatilities = volatilities.clip(lower=min_vol)
     
-    inv_vol = 1 / volatilities
-    weights = inv_vol / inv_vol.sum()
-    return weights
+    # Work on the raw array so each step avoids building an intermediate Series
+    inv_vol = 1.0 / np.maximum(volatilities.to_numpy(dtype=np.float64), min_vol)
+    inv_vol /= inv_vol.sum()
+    return pd.Series(inv_vol, index=volatilities.index)
 
 def optimize_asset_location(total_portfolio_value, target_weights, accounts):
     """
@@ -64,70 +129,58 @@ def optimize_asset_location(total_portfolio_value, target_weights, accounts):
     # 1. Determine Target $ Amount for each Asset
     target_amounts = target_weights * total_portfolio_value
     
-    # 2. Define Tax Inefficiency Score (Arbitrary Heuristic for this demo)
-    # Higher score = Worse for taxable account (Needs shelter)
-    tax_inefficiency = {
-        'TLT': 10, 'IEF': 10, 'BND': 10,  # Bonds (Interest taxed as income)
-        'GLD': 8, 'DBC': 8,               # Commodities (Collectibles tax / K-1s)
-        'VNQ': 9,                         # REITs (Unqualified divs)
-        'SPY': 2, 'VTI': 2, 'QQQ': 2,     # Stocks (Capital gains/Qualified divs)
-        'EEM': 3, 'VEA': 3                # International (Foreign tax credit potential)
-    }
+    # 2. Look up Tax Inefficiency Score; unknown tickers get a middling score of 5
+    scores = target_amounts.index.map(TAX_INEFFICIENCY)
+    scores = scores.where(scores.notna(), 5).to_numpy()
     
     # Create a DataFrame for allocation logic
     assets_df = pd.DataFrame({
         'Target_Value': target_amounts,
-        'Inefficiency_Score': [tax_inefficiency.get(t, 5) for t in target_amounts.index]
+        'Inefficiency_Score': scores
     }).sort_values(by='Inefficiency_Score', ascending=False) # Most inefficient first
     
     # Prepare Accounts (Sort by tax advantage priority)
     # Priority: Roth/HSA (Best) > Trad/401k (Deferral) > Taxable (Worst)
-    sorted_accounts = []
-    for acc_name, balance in accounts.items():
-        priority = 3 # Default to taxable
-        if 'Roth' in acc_name or 'HSA' in acc_name: 
-            priority = 1
-        elif 'IRA' in acc_name or '401k' in acc_name: 
-            priority = 2
-        
-        sorted_accounts.append({
-            'Name': acc_name,
-            'Balance': balance,
-            'Remaining': balance,
-            'Priority': priority,
-            'Holdings': {}
-        })
-    
-    # Sort accounts: Best shelter first
-    sorted_accounts.sort(key=lambda x: x['Priority'])
+    account_names = np.array(list(accounts.keys()), dtype=object)
+    balances = np.fromiter(accounts.values(), dtype=np.float64, count=len(accounts))
+    priorities = np.array([account_priority(acc_name) for acc_name in account_names], dtype=np.int64)
+    
+    # Sort accounts: Best shelter first (stable, so ties keep their input order)
+    order = np.argsort(priorities, kind='stable')
+    account_names, balances, priorities = account_names[order], balances[order], priorities[order]
     
     # 3. The Filling Algorithm
-    final_allocation = []
-    
-    for asset, row in assets_df.iterrows():
-        amount_needed = row['Target_Value']
-        
-        for account in sorted_accounts:
-            if amount_needed <= 0:
-                break
-                
-            if account['Remaining'] > 0:
-                # How much of this asset can we fit in this account?
-                amount_to_place = min(amount_needed, account['Remaining'])
-                
-                # Update tracking
-                account['Holdings'][asset] = amount_to_place
-                account['Remaining'] -= amount_to_place
-                amount_needed -= amount_to_place
-                
-                final_allocation.append({
-                    'Account': account['Name'],
-                    'Asset': asset,
-                    'Value': amount_to_place,
-                    'Tax_Type': 'Tax-Free' if account['Priority'] == 1 else ('Deferred' if account['Priority'] == 2 else 'Taxable')
-                })
-                
-    return pd.DataFrame(final_allocation)
+    # Lay assets and accounts end to end on the same dollar axis. Every point where
+    # either an asset or an account runs out closes one (asset, account) placement.
+    asset_ends = np.cumsum(assets_df['Target_Value'].to_numpy(dtype=np.float64))
+    account_ends = np.cumsum(balances)
+    
+    # Nothing can be placed beyond the smaller of the two totals
+    filled = min(asset_ends.max(initial=0.0), account_ends.max(initial=0.0))
+    breakpoints = np.union1d(asset_ends, account_ends)
+    breakpoints = breakpoints[breakpoints <= filled]
+    
+    values = np.diff(breakpoints, prepend=0.0)
+    placed = values > 0
+    breakpoints, values = breakpoints[placed], values[placed]
+    
+    # Each segment belongs to the first asset/account whose running total reaches its end
+    asset_idx = np.searchsorted(asset_ends, breakpoints, side='left')
+    account_idx = np.searchsorted(account_ends, breakpoints, side='left')
+    
+    return pd.DataFrame({
+        'Account': account_names[account_idx],
+        'Asset': assets_df.index.to_numpy()[asset_idx],
+        'Value': values,
+        'Tax_Type': np.array(TAX_LABELS, dtype=object)[priorities[account_idx] - 1]
+    })
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=32, show_spinner=False)
+def allocation_pie_chart(weights, names):
+    """Build the allocation pie chart (cached per weights/tickers)."""
+    import plotly.express as px  # Deferred: heavy import, only needed once results are shown
+    
+    return px.pie(values=list(weights), names=list(names), title='Risk Parity Allocation')
 
 # --- UI LAYOUT ---
 
@@ -142,7 +195,8 @@ st.markdown("""
 with st.sidebar:
     st.header("1. Portfolio Configuration")
     tickers_input = st.text_area("Tickers (comma separated)", "SPY, TLT, GLD, VNQ, EEM", height=70)
-    tickers = [t.strip().upper() for t in tickers_input.split(',')]
+    # De-duplicate (keeping input order) so repeated tickers don't produce duplicate labels
+    tickers = list(dict.fromkeys(t.strip().upper() for t in tickers_input.split(',')))
     
     lookback = st.selectbox("Volatility Lookback", ["3mo", "6mo", "1y", "2y"], index=2)
     rebalance_band = st.slider("Rebalance Threshold (%)", 1, 20, 5, help="Only rebalance if drift > X%. Tighter bands = more trades (Shannon's Demon) but higher costs.")
@@ -161,7 +215,7 @@ if st.button("Analyze & Generate Trades"):
     with st.spinner('Fetching market data and optimizing...'):
         try:
             # 1. Get Data & Calculate Targets
-            vols, prices = get_market_data(tickers, period=lookback)
+            vols, prices = get_market_data(tuple(tickers), period=lookback)
             target_weights = calculate_risk_parity_weights(vols)
             
             st.subheader("1. Risk Parity Targets (Inverse Volatility)")
@@ -169,19 +223,28 @@ if st.button("Analyze & Generate Trades"):
             # Display Weights & Vols
             col1, col2 = st.columns(2)
             
+            # Sort once (highest weight first) and build the table already in that order.
+            # Percent columns hold 0-100 values since column formats don't rescale
+            weights = target_weights.to_numpy()
+            order = np.argsort(-weights, kind='stable')
             display_df = pd.DataFrame({
-                'Volatility (Ann.)': vols,
-                'Target Weight': target_weights,
-                'Target Value ($)': target_weights * total_equity
-            }).sort_values(by='Target Weight', ascending=False)
+                'Volatility (Ann.)': vols.to_numpy()[order] * 100,
+                'Target Weight': weights[order] * 100,
+                'Target Value ($)': weights[order] * total_equity
+            }, index=target_weights.index[order])
             
-            col1.dataframe(display_df.style.format({
-                'Volatility (Ann.)': '{:.2%}',
-                'Target Weight': '{:.2%}',
-                'Target Value ($)': '${:,.2f}'
-            }))
+            # Percentages only need 4 significant digits, so ship them as float32;
+            # dollar amounts stay float64 to keep cents exact on large portfolios
+            col1.dataframe(
+                display_df.astype({'Volatility (Ann.)': 'float32', 'Target Weight': 'float32'}),
+                column_config={
+                    'Volatility (Ann.)': st.column_config.NumberColumn(format='%.2f%%'),
+                    'Target Weight': st.column_config.NumberColumn(format='%.2f%%'),
+                    'Target Value ($)': st.column_config.NumberColumn(format='$%.2f')
+                }
+            )
             
-            fig = px.pie(display_df, values='Target Weight', names=display_df.index, title='Risk Parity Allocation')
+            fig = allocation_pie_chart(tuple(np.round(display_df['Target Weight'].to_numpy(), 6)), tuple(display_df.index))
             col2.plotly_chart(fig, use_container_width=True)
             
             # 2. Asset Location Optimization
@@ -196,9 +259,12 @@ if st.button("Analyze & Generate Trades"):
             
             allocation_plan = optimize_asset_location(total_equity, target_weights, accounts)
             
-            # Pivot for readability
-            pivot_plan = allocation_plan.pivot_table(index='Asset', columns='Account', values='Value', fill_value=0)
-            st.dataframe(pivot_plan.style.format("${:,.0f}"))
+            # Pivot for readability (each Asset/Account pair is unique, so no aggregation needed)
+            pivot_plan = allocation_plan.set_index(['Asset', 'Account'])['Value'].unstack(fill_value=0)
+            st.dataframe(
+                pivot_plan,
+                column_config={account: st.column_config.NumberColumn(format='$%.0f') for account in pivot_plan.columns}
+            )
 
             # 3. Trade Generation (Mockup logic for rebalancing)
             st.subheader("3. Action Plan (Shannon's Demon)")
@@ -208,32 +274,37 @@ if st.button("Analyze & Generate Trades"):
             Only execute trades if the weight drift exceeds **{rebalance_band}%** to capture volatility variance.*
             """)
             
-            # Group by Account for the "Shopping List"
+            # Price every placement once, then split into per-account "Shopping Lists"
+            allocation_plan['Current_Price'] = allocation_plan['Asset'].map(prices)
+            allocation_plan['Shares_To_Own'] = allocation_plan['Value'] / allocation_plan['Current_Price']
+            
+            # Validate prices before trusting the share counts
+            bad_price = allocation_plan['Current_Price'].isna() | (allocation_plan['Current_Price'] <= 0)
+            has_bad_price = bad_price.groupby(allocation_plan['Account'], sort=False).any()
+            account_plans = dict(tuple(allocation_plan.groupby('Account', sort=False)))
+            
+            # Group by Account for the "Shopping List", rendered as a single HTML block
+            money = '${:,.2f}'.format
+            formatters = {'Value': money, 'Current_Price': money, 'Shares_To_Own': '{:,.2f}'.format}
+            shopping_lists = []
+            bad_price_accounts = []
             for account in accounts.keys():
-                st.markdown(f"**{account}**")
-                subset = allocation_plan[allocation_plan['Account'] == account]
-                if subset.empty:
-                    st.write("No assets allocated to this account.")
+                shopping_lists.append(f"<p><strong>{html.escape(account)}</strong></p>")
+                subset = account_plans.get(account)
+                if subset is None:
+                    shopping_lists.append("<p>No assets allocated to this account.</p>")
+                    continue
+                
+                columns = ['Asset', 'Value', 'Current_Price']
+                if has_bad_price[account]:
+                    bad_price_accounts.append(account)
                 else:
-                    # Calculate shares
-                    subset = subset.copy()
-                    subset['Current_Price'] = subset['Asset'].map(prices)
-                    
-                    # Validate prices before division
-                    if subset['Current_Price'].isna().any() or (subset['Current_Price'] <= 0).any():
-                        st.warning(f"Warning: Some assets in {account} have invalid prices. Shares calculation skipped.")
-                        st.table(subset[['Asset', 'Value', 'Current_Price']].style.format({
-                            'Value': '${:,.2f}',
-                            'Current_Price': '${:,.2f}'
-                        }))
-                    else:
-                        subset['Shares_To_Own'] = subset['Value'] / subset['Current_Price']
-                        
-                        st.table(subset[['Asset', 'Value', 'Current_Price', 'Shares_To_Own']].style.format({
-                            'Value': '${:,.2f}',
-                            'Current_Price': '${:,.2f}',
-                            'Shares_To_Own': '{:,.2f}'
-                        }))
+                    columns.append('Shares_To_Own')
+                shopping_lists.append(subset[columns].to_html(index=False, formatters=formatters))
+            
+            if bad_price_accounts:
+                st.warning(f"Warning: Some assets in {', '.join(bad_price_accounts)} have invalid prices. Shares calculation skipped.")
+            st.markdown("\n".join(shopping_lists), unsafe_allow_html=True)
 
         except Exception as e:
             st.error(f"An error occurred: {e}")